@@ -15,36 +15,54 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import concurrent.futures
+import errno
+import mmap
 import os
+import time
 
 import boto3
 import click
-from tqdm import tqdm, trange
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from tqdm import tqdm
 
-from .utils.tree_hash import calculate_tree_hash
+from .utils import checkpoint
+from .utils.jobs import initiate_job, wait_for_job
+from .utils.transfer import (
+    MAX_AUTO_THREADS,
+    MAX_DOWNLOAD_ATTEMPTS,
+    MIN_AUTO_THREADS,
+    retry_delay,
+    tune_num_threads,
+)
+from .utils.tree_hash import TreeHasher, calculate_tree_hash
 
-BITE_SIZE = 4096  # 4 KB
+BITE_SIZE = 1024 * 1024  # 1 MB
 CHUNK_SIZE = 32 * 1024 * 1024  # 32 MB
+MAX_CHUNK_SIZE = 1024 * 1024 * 1024  # 1 GB
+TARGET_NUMBER_OF_CHUNKS = 256
 
 
 def init_retrieval(vault_name, archive_id, description, tier):
-    glacier = boto3.client("glacier")
-
-    job_params = {"Type": "archive-retrieval", "ArchiveId": archive_id, "Tier": tier}
-    if description is not None:
-        job_params["Description"] = description
-
-    click.echo("Sending archive-retrieval initiation request...")
-    try:
-        response = glacier.initiate_job(vaultName=vault_name, jobParameters=job_params)
-    except glacier.exceptions.ResourceNotFoundException as e:
-        raise click.ClickException(e.response["Error"]["Message"])
-
-    click.echo(f"Job initiation request received. Job ID: {response['jobId']}")
+    initiate_job(
+        vault_name,
+        {"Type": "archive-retrieval", "ArchiveId": archive_id, "Tier": tier},
+        description,
+    )
 
 
-def get(vault_name, job_id, file_name):
-    glacier = boto3.client("glacier")
+def get(vault_name, job_id, file_name, num_threads, wait):
+    glacier = boto3.client(
+        "glacier",
+        config=Config(
+            # one pooled connection per worker thread, botocore defaults to 10
+            max_pool_connections=max(num_threads or MAX_AUTO_THREADS, 10),
+            # botocore retries failed requests, download_archive_part only
+            # retries parts that break off or whose checksum doesn't match
+            retries={"mode": "standard", "total_max_attempts": MAX_DOWNLOAD_ATTEMPTS},
+            tcp_keepalive=True,
+        ),
+    )
 
     click.echo(f"Checking status of job {job_id} in {vault_name}...")
     try:
@@ -60,8 +78,10 @@ def get(vault_name, job_id, file_name):
     click.echo(f"Job status: {job_desc['StatusCode']}")
 
     if not job_desc["Completed"]:
-        click.echo("Job is not completed.")
-        return
+        if not wait:
+            click.echo("Job is not completed.")
+            return
+        job_desc = wait_for_job(glacier, vault_name, job_id, job_desc)
     if job_desc["StatusCode"] != "Succeeded":
         click.echo("Job unsuccessful, unable to download.")
         return
@@ -71,17 +91,20 @@ def get(vault_name, job_id, file_name):
             f"Are you sure you want to overwrite the file {file_name}?", abort=True
         )
 
-    content_length = int(job_desc["ArchiveSizeInBytes"])
+    content_length = retrieval_size(job_desc)
     try:
         job_output = glacier.get_job_output(vaultName=vault_name, jobId=job_id)
     except glacier.exceptions.ResourceNotFoundException:
         click.secho("Unable to download, job has expired.", fg="red")
         return
 
+    # the archive is written to a partial file first, and only takes the place
+    # of file_name once it's complete and its checksum matches
+    partial_file_name = f"{file_name}.part"
     if content_length < CHUNK_SIZE:
         response_stream = job_output["body"]
         try:
-            with open(file_name, "wb") as f:
+            with open(partial_file_name, "wb") as f:
                 with tqdm(
                     total=content_length,
                     unit="B",
@@ -89,105 +112,278 @@ def get(vault_name, job_id, file_name):
                     unit_divisor=1024,
                     desc="Downloading file",
                 ) as bar:
+                    hasher = TreeHasher()
                     for chunk in response_stream.iter_chunks(BITE_SIZE):
                         # iter_chunks returns bytes in chunk format
                         # by calling read internally for chunk_size
                         # https://github.com/boto/botocore/blob/51bcacab620bbb35c84157d61b9fed93f2a467f6/botocore/response.py#L125
                         f.write(chunk)
+                        hasher.update(chunk)
                         bar.update(len(chunk))
         finally:
             response_stream.close()
+        if job_output.get("checksum") not in (None, hasher.hexdigest()):
+            os.remove(partial_file_name)
+            raise click.ClickException(
+                f"Checksums do not match, {file_name} was not downloaded correctly"
+            )
+        os.replace(partial_file_name, file_name)
+        click.echo("Archive downloaded.")
         return
 
-    parts_dir = f"{file_name}_parts"
-    if not os.path.isdir(parts_dir):
-        os.mkdir(parts_dir)
+    # parts are written straight into place in the partial file, which is kept
+    # when the download fails so that running the command again resumes it. The
+    # tree hash of every part written is recorded next to it, for the resume to
+    # check the parts against without requesting them again.
+    resuming = os.path.exists(partial_file_name)
+    chunk_size = choose_chunk_size(content_length)
+    checksums_file_name = f"{partial_file_name}.jsonl"
+    source_id = f"{vault_name}/{job_id}/{chunk_size}"
+    with open(partial_file_name, "r+b" if resuming else "w+b") as f:
+        f.truncate(content_length)
+        reserve_space(f, content_length)
+        with mmap.mmap(f.fileno(), content_length) as file_map:
+            start_bytes = list(range(0, content_length, chunk_size))
+            with tqdm(
+                total=len(start_bytes), unit="part", desc="Downloading archive parts"
+            ) as bar:
+                known_checksums = {}
+                if resuming:
+                    # check what an earlier run already wrote, all parts at once,
+                    # so that only the missing ones are downloaded again
+                    known_checksums = checkpoint.load_checkpoint(
+                        checksums_file_name, source_id
+                    )
+                    start_bytes = verify_archive_parts(
+                        file_map,
+                        start_bytes,
+                        chunk_size,
+                        known_checksums,
+                        num_threads or MAX_AUTO_THREADS,
+                        bar,
+                    )
+                    known_checksums = {
+                        start_byte: checksum
+                        for start_byte, checksum in known_checksums.items()
+                        if start_byte not in start_bytes
+                    }
+                checkpoint.start_checkpoint(
+                    checksums_file_name, source_id, known_checksums
+                )
+
+                if num_threads is None:
+                    num_threads = MIN_AUTO_THREADS
+                    if start_bytes:
+                        # time one part on its own to see how many connections it
+                        # takes to saturate the link
+                        start_byte = start_bytes.pop(0)
+                        checksum, transfer_seconds = download_archive_part(
+                            glacier,
+                            vault_name,
+                            job_id,
+                            file_map,
+                            start_byte,
+                            chunk_size,
+                        )
+                        checkpoint.record_part(
+                            checksums_file_name, start_byte, checksum
+                        )
+                        report_part(bar, start_byte // chunk_size)
+                        num_threads = tune_num_threads(
+                            min(chunk_size, content_length - start_byte),
+                            transfer_seconds,
+                        )
+                        tqdm.write(f"Will download with {num_threads} threads.")
+
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=num_threads
+                ) as executor:
+                    future_list = {
+                        executor.submit(
+                            download_archive_part,
+                            glacier,
+                            vault_name,
+                            job_id,
+                            file_map,
+                            start_byte,
+                            chunk_size,
+                        ): start_byte
+                        for start_byte in start_bytes
+                    }
+                    # the other parts are finished before a failure is raised,
+                    # record them too so that a resume doesn't download them again
+                    error = None
+                    for future in concurrent.futures.as_completed(future_list):
+                        try:
+                            checksum, _ = future.result()
+                        except Exception as e:
+                            error = error or e
+                            continue
+                        start_byte = future_list[future]
+                        checkpoint.record_part(
+                            checksums_file_name, start_byte, checksum
+                        )
+                        report_part(bar, start_byte // chunk_size)
+                    if error:
+                        raise error
+            file_map.flush()
+    os.replace(partial_file_name, file_name)
+    checkpoint.remove_checkpoint(checksums_file_name)
+
+    click.echo("Archive downloaded.")
+
+
+def retrieval_size(job_desc):
+    # a job can retrieve just a range of the archive, and its output is only that
+    # range. RetrievalByteRange is inclusive on both ends.
+    byte_range = job_desc.get("RetrievalByteRange")
+    if not byte_range:
+        return int(job_desc["ArchiveSizeInBytes"])
+    start_byte, _, end_byte = byte_range.partition("-")
+    return int(end_byte) - int(start_byte) + 1
+
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
+def report_part(bar, part_number):
+    bar.update(1)
+    tqdm.write(f"File part {part_number} downloaded")
+
+
+def verify_archive_parts(
+    file_map, start_bytes, chunk_size, known_checksums, num_threads, bar
+):
+    # returns the start of every part that still has to be downloaded. Parts
+    # without a recorded checksum were never completed, and aren't hashed.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
         future_list = {
             executor.submit(
-                download_archive_part,
-                glacier,
-                vault_name,
-                job_id,
-                file_name,
+                verify_archive_part,
+                file_map,
                 start_byte,
+                chunk_size,
+                known_checksums[start_byte],
             ): start_byte
-            for start_byte in range(0, content_length, CHUNK_SIZE)
+            for start_byte in start_bytes
+            if start_byte in known_checksums
         }
-        with tqdm(
-            total=len(future_list),
-            unit="part",
-            desc="Downloading archive parts",
-        ) as bar:
-            for future in concurrent.futures.as_completed(future_list):
+        missing = [
+            start_byte
+            for start_byte in start_bytes
+            if start_byte not in known_checksums
+        ]
+        for future in concurrent.futures.as_completed(future_list):
+            start_byte = future_list[future]
+            part_number = start_byte // chunk_size
+            if future.result():
                 bar.update(1)
-                result = future.result()  # re-throw any exceptions
-                start_byte = future_list[future]
-                part_number = start_byte // CHUNK_SIZE
-                if result == "skipped":
-                    tqdm.write(f"Skipping part {part_number}")
-                else:
-                    tqdm.write(f"File part {part_number} downloaded")
-
-    with open(file_name, "wb") as final_file:
-        for part_number in trange(
-            len(future_list),
-            unit="part",
-            desc="Consolidating archive parts",
-        ):
-            with open(os.path.join(parts_dir, f"{part_number:04}"), "rb") as part_file:
-                final_file.write(part_file.read())
-
-    for part_number in trange(
-        len(future_list),
-        unit="part",
-        desc="Deleting archive parts",
-    ):
-        os.remove(os.path.join(parts_dir, f"{part_number:04}"))
-    os.rmdir(parts_dir)
+                tqdm.write(f"Skipping part {part_number}")
+            else:
+                tqdm.write(
+                    f"Checksums do not match for part {part_number}, redownloading"
+                )
+                missing.append(start_byte)
+    return sorted(missing)
 
-    click.echo("Archive downloaded.")
 
+def verify_archive_part(file_map, start_byte, chunk_size, checksum):
+    end_byte = min(start_byte + chunk_size, len(file_map))
+    with memoryview(file_map)[start_byte:end_byte] as part:
+        return calculate_tree_hash(part, chunk_size) == checksum
 
-def download_archive_part(glacier_client, vault_name, job_id, file_name, start_byte):
-    part_number = start_byte // CHUNK_SIZE
-    part_file_name = os.path.join(f"{file_name}_parts", f"{part_number:04}")
 
-    download_range = f"bytes={start_byte}-{start_byte+CHUNK_SIZE-1}"
-    job_output = glacier_client.get_job_output(
-        vaultName=vault_name, jobId=job_id, range=download_range
-    )
-    if os.path.lexists(part_file_name):
-        if verify_file_checksum(part_file_name, job_output["checksum"]):
-            return "skipped"
-        tqdm.write(f"Checksums do not match for part {part_number}, redownloading")
+def download_archive_part(
+    glacier_client, vault_name, job_id, file_map, start_byte, chunk_size
+):
+    # returns the part's tree hash, and the time taken by the attempt that
+    # succeeded
+    part_number = start_byte // chunk_size
+    end_byte = min(start_byte + chunk_size, len(file_map))
+    download_range = f"bytes={start_byte}-{end_byte - 1}"
+
+    with memoryview(file_map)[start_byte:end_byte] as part:
+        error = None
+        for attempt in range(MAX_DOWNLOAD_ATTEMPTS):
+            if attempt > 0:
+                tqdm.write(f"Trying again. Part {part_number}")
+                time.sleep(retry_delay(attempt))
+            started = time.monotonic()
+            job_output = glacier_client.get_job_output(
+                vaultName=vault_name, jobId=job_id, range=download_range
+            )
+            response_stream = job_output["body"]
+            try:
+                checksum = read_archive_part(response_stream, part, part_number)
+            except BotoCoreError as e:
+                # the connection broke off while streaming the part, which
+                # botocore doesn't retry once the response has been returned
+                error = e
+            else:
+                if checksum == job_output["checksum"]:
+                    return checksum, time.monotonic() - started
+                error = Exception(f"Checksums do not match for part {part_number}")
+            finally:
+                response_stream.close()
+            tqdm.write(f"Download error: {error}")
+
+        raise error
+
+
+def read_archive_part(response_stream, part, part_number):
+    with tqdm(
+        total=len(part),
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=f"Download part {part_number}",
+        leave=False,
+    ) as bar:
+        # hash the part as it arrives rather than reading it back afterwards
+        hasher = TreeHasher()
+        pos = 0
+        while pos < len(part):
+            # read straight into the mapped file, without a bytes object per chunk.
+            # The slice is released right away, a failed read's traceback would
+            # otherwise keep it alive and stop the file map from being closed.
+            with part[pos : pos + BITE_SIZE] as chunk:
+                read_size = read_into(response_stream, chunk)
+                hasher.update(chunk[:read_size])
+            if not read_size:
+                break
+            pos += read_size
+            bar.update(read_size)
+    return hasher.hexdigest()
 
-    response_stream = job_output["body"]
+
+def reserve_space(f, size_bytes):
+    # allocate the whole file up front, in as few extents as the filesystem can.
+    # Running out of space while writing through the file map would otherwise
+    # kill the process with SIGBUS instead of raising an error.
+    if not hasattr(os, "posix_fallocate"):
+        return
     try:
-        with open(part_file_name, "wb") as f:
-            with tqdm(
-                total=CHUNK_SIZE,
-                unit="B",
-                unit_scale=True,
-                unit_divisor=1024,
-                desc=f"Download part {part_number}",
-                leave=False,
-            ) as bar:
-                for chunk in response_stream.iter_chunks(BITE_SIZE):
-                    f.write(chunk)
-                    bar.update(len(chunk))
-    finally:
-        response_stream.close()
-
-    if not verify_file_checksum(part_file_name, job_output["checksum"]):
-        raise Exception(f"Checksums do not match for part {part_number}")
-
-
-def verify_file_checksum(file_name, checksum, max_size=CHUNK_SIZE):
-    # click.echo(f"Glacier checksum: {checksum}")
-    with open(file_name, "rb") as f:
-        file_contents = f.read()
-    calculated_checksum = calculate_tree_hash(file_contents, max_size)
-    # click.echo(f"Calculated checksum: {calculated_checksum}")
-    return calculated_checksum == checksum
+        os.posix_fallocate(f.fileno(), 0, size_bytes)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise click.ClickException(f"Not enough disk space for {f.name}")
+        # the filesystem doesn't support preallocation, keep the sparse file
+
+
+def choose_chunk_size(content_length):
+    # larger archives are split into larger parts, so that the number of range
+    # requests stays around TARGET_NUMBER_OF_CHUNKS. Parts stay a power of 2 in
+    # MB, since glacier only returns a tree hash for megabyte aligned ranges.
+    chunk_size = CHUNK_SIZE
+    while (
+        chunk_size < MAX_CHUNK_SIZE
+        and content_length / chunk_size > TARGET_NUMBER_OF_CHUNKS
+    ):
+        chunk_size *= 2
+    return chunk_size
+
+
+def read_into(response_stream, buffer):
+    if hasattr(response_stream, "readinto"):
+        return response_stream.readinto(buffer)
+    # older botocore versions have no StreamingBody.readinto
+    data = response_stream.read(len(buffer))
+    buffer[: len(data)] = data
+    return len(data)
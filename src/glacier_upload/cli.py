@@ -14,11 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
-
 import click
 
-from . import archives, inventories, upload
+# the command modules import boto3, which takes most of the startup time, so they
+# are only imported by the command that runs. This keeps --help and shell
+# completion fast.
 
 
 @click.group()
@@ -38,23 +38,41 @@ def glacier_cli():
     "--part-size",
     "part_size_mb",
     type=int,
-    default=8,
     help=(
-        "The part size for multipart upload, in megabytes as a power of 2"
-        "(e.g. 1, 2, 4, 8). Default: 8"
+        "The part size for multipart upload, in megabytes as a power of 2 "
+        "(e.g. 1, 2, 4, 8). Default: 8, or the smallest power of 2 that keeps the "
+        "upload within 10,000 parts"
     ),
 )
 @click.option(
     "-t",
     "--num-threads",
-    type=int,
-    default=((os.cpu_count() or 1) * 5),
+    type=click.IntRange(min=1),
     help=(
         "The amount of worker threads concurrently uploading data. "
-        "Default: Number of CPUs multiplied by 5"
+        "Default: tuned from the upload speed of the first part"
     ),
 )
 @click.option("-u", "--upload-id", help="If provided, will resume upload with this ID.")
+@click.option(
+    "-c",
+    "--compression",
+    type=click.Choice(["xz", "zstd", "gz", "bz2", "none"]),
+    default="xz",
+    help=(
+        "How to compress the tar file when files are consolidated. xz makes the "
+        "smallest archives but is by far the slowest, zstd (needs the zstd command) "
+        "and gz are much faster for slightly larger archives. Default: xz"
+    ),
+)
+@click.option(
+    "--compression-level",
+    type=click.IntRange(0, 9),
+    help=(
+        "Compression level from 1 (fastest) to 9 (smallest), xz also takes 0. "
+        "Default: the compressor's default"
+    ),
+)
 @click.argument("vault_name")
 @click.argument("file_name", nargs=-1, type=click.Path(exists=True))
 def upload_archive(**args):
@@ -64,6 +82,8 @@ def upload_archive(**args):
     is a directory, the directory and its contents will be consolidated into a single
     tar file and uploaded.
     """
+    from . import upload
+
     return upload.upload_archive(**args)
 
 
@@ -96,19 +116,29 @@ def init_inventory_retrieval(vault_name, format, description):
     this job, run get-inventory with the vault name and job ID
     returned by this function.
     """
+    from . import inventories
+
     return inventories.init_retrieval(vault_name, format, description)
 
 
 @inventory_group.command(name="get")
+@click.option(
+    "-w",
+    "--wait",
+    is_flag=True,
+    help="Wait for the job to complete instead of exiting if it isn't yet.",
+)
 @click.argument("vault_name")
 @click.argument("job_id")
-def get_inventory(vault_name, job_id):
+def get_inventory(vault_name, job_id, wait):
     """
     Get the output of an inventory retrieval job identified by JOB_ID in VAULT_NAME.
 
     The inventory job must have already been initialized by init-inventory-retrieval.
     """
-    return inventories.get(vault_name, job_id)
+    from . import inventories
+
+    return inventories.get(vault_name, job_id, wait)
 
 
 @glacier_cli.group(name="archive")
@@ -139,17 +169,34 @@ def init_archive_retrieval(vault_name, archive_id, description, tier):
     the archive. To check the status and retrieve the archive, run
     glacier-get-archive with the vault name and job ID returned by this function.
     """
+    from . import archives
+
     return archives.init_retrieval(vault_name, archive_id, description, tier)
 
 
 @archive_group.command(name="get")
+@click.option(
+    "-t",
+    "--num-threads",
+    type=click.IntRange(min=1),
+    help=(
+        "The amount of worker threads concurrently downloading parts of the "
+        "archive. Default: tuned from the download speed of the first part"
+    ),
+)
+@click.option(
+    "-w",
+    "--wait",
+    is_flag=True,
+    help="Wait for the job to complete instead of exiting if it isn't yet.",
+)
 @click.argument("vault_name")
 @click.argument("job_id")
 @click.argument(
     "file_name",
     type=click.Path(dir_okay=False, writable=True),
 )
-def get_archive(vault_name, job_id, file_name):
+def get_archive(vault_name, job_id, file_name, num_threads, wait):
     """
     Get the output of an archive retrieval job identified by JOB_ID in VAULT_NAME
     and save it to FILE_NAME.
@@ -157,4 +204,6 @@ def get_archive(vault_name, job_id, file_name):
     The archive retrieval job must have already been initialized by
     glacier-init-archive-retrieval command.
     """
-    return archives.get(vault_name, job_id, file_name)
+    from . import archives
+
+    return archives.get(vault_name, job_id, file_name, num_threads, wait)
@@ -14,30 +14,42 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
+import itertools
 import json
+import time
 
 import boto3
 import click
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
 
+from .utils.jobs import initiate_job, wait_for_job
+from .utils.transfer import MAX_DOWNLOAD_ATTEMPTS, retry_delay
+from .utils.tree_hash import calculate_tree_hash
 
-def init_retrieval(vault_name, format, description):
-    glacier = boto3.client("glacier")
-
-    job_params = {"Type": "inventory-retrieval", "Format": format}
-    if description is not None:
-        job_params["Description"] = description
+# inventories larger than this are downloaded in ranges of this size, several at
+# a time
+INVENTORY_RANGE_SIZE = 32 * 1024 * 1024  # 32 MB
+INVENTORY_NUM_THREADS = 10
 
-    click.echo("Sending inventory-retrieval initiation request...")
-    try:
-        response = glacier.initiate_job(vaultName=vault_name, jobParameters=job_params)
-    except glacier.exceptions.ResourceNotFoundException as e:
-        raise click.ClickException(e.response["Error"]["Message"])
 
-    click.echo(f"Job initiation request received. Job ID: {response['jobId']}")
+def init_retrieval(vault_name, format, description):
+    initiate_job(
+        vault_name, {"Type": "inventory-retrieval", "Format": format}, description
+    )
 
 
-def get(vault_name, job_id):
-    glacier = boto3.client("glacier")
+def get(vault_name, job_id, wait):
+    glacier = boto3.client(
+        "glacier",
+        config=Config(
+            # botocore retries failed requests, download_inventory_range only
+            # retries ranges that break off or whose checksum doesn't match
+            retries={"mode": "standard", "total_max_attempts": MAX_DOWNLOAD_ATTEMPTS}
+        ),
+    )
 
     click.echo("Checking inventory retrieval status...")
     try:
@@ -53,14 +65,98 @@ def get(vault_name, job_id):
     click.echo(f"Inventory status: {response['StatusCode']}")
 
     if not response["Completed"]:
-        click.echo("Inventory is not completed.")
-        return
+        if not wait:
+            click.echo("Inventory is not completed.")
+            return
+        response = wait_for_job(glacier, vault_name, job_id, response)
 
     click.echo("Retrieving job data...")
-    response = glacier.get_job_output(vaultName=vault_name, jobId=job_id)
+    content_type, chunks = download_inventory(
+        glacier, vault_name, job_id, response.get("InventorySizeInBytes") or 0
+    )
 
-    if response["contentType"] == "application/json":
-        inventory_json = json.load(response["body"])
+    if content_type == "application/json" and click.get_text_stream("stdout").isatty():
+        # only pretty-print for people, parsing and indenting a large inventory
+        # is slow
+        inventory_json = json.loads(b"".join(chunks))
         click.echo(json.dumps(inventory_json, indent=2))
     else:
-        click.echo(response["body"].read())
+        # stream CSV inventories, and JSON ones that are piped or redirected,
+        # as they are instead of reading them into memory in one piece
+        for chunk in chunks:
+            click.echo(chunk, nl=False)
+
+
+def download_inventory(glacier, vault_name, job_id, inventory_size_bytes):
+    # returns the inventory's content type and an iterator over its bytes
+    if inventory_size_bytes <= INVENTORY_RANGE_SIZE:
+        response = glacier.get_job_output(vaultName=vault_name, jobId=job_id)
+        return response["contentType"], response["body"].iter_chunks(1024 * 1024)
+
+    # large inventories are fetched as several ranges at once, like archives
+    ranges = iter_inventory_ranges(glacier, vault_name, job_id, inventory_size_bytes)
+    content_type, data = next(ranges)
+    return content_type, itertools.chain([data], (data for _, data in ranges))
+
+
+def iter_inventory_ranges(glacier, vault_name, job_id, inventory_size_bytes):
+    # yields (content_type, data) for each range in order. Only a window of
+    # ranges is downloaded ahead of the one being written out, so memory use
+    # doesn't grow with the inventory when stdout drains slowly.
+    start_bytes = iter(range(0, inventory_size_bytes, INVENTORY_RANGE_SIZE))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=INVENTORY_NUM_THREADS
+    ) as executor:
+        in_flight = collections.deque()
+        try:
+            while True:
+                for start_byte in itertools.islice(
+                    start_bytes, INVENTORY_NUM_THREADS - len(in_flight)
+                ):
+                    in_flight.append(
+                        executor.submit(
+                            download_inventory_range,
+                            glacier,
+                            vault_name,
+                            job_id,
+                            start_byte,
+                            min(
+                                start_byte + INVENTORY_RANGE_SIZE, inventory_size_bytes
+                            ),
+                        )
+                    )
+                if not in_flight:
+                    return
+                yield in_flight.popleft().result()
+        finally:
+            # on errors, or when the output is abandoned, don't start the rest
+            for future in in_flight:
+                future.cancel()
+
+
+def download_inventory_range(glacier, vault_name, job_id, start_byte, end_byte):
+    download_range = f"bytes={start_byte}-{end_byte - 1}"
+    error = None
+    for attempt in range(MAX_DOWNLOAD_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(retry_delay(attempt))
+        response = glacier.get_job_output(
+            vaultName=vault_name, jobId=job_id, range=download_range
+        )
+        try:
+            data = response["body"].read()
+        except BotoCoreError as e:
+            # the connection broke off while streaming the range, which botocore
+            # doesn't retry once the response has been returned
+            error = e
+        else:
+            # ranges are megabyte aligned, so glacier returns their tree hash
+            checksum = response.get("checksum")
+            if checksum in (None, calculate_tree_hash(data, INVENTORY_RANGE_SIZE)):
+                return response["contentType"], data
+            error = Exception(f"Checksums do not match for inventory {download_range}")
+        finally:
+            response["body"].close()
+        click.secho(f"Download error: {error}", err=True, fg="red")
+
+    raise error
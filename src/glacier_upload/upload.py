@@ -14,19 +14,43 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bz2
 import concurrent.futures
+import contextlib
+import gzip
+import io
+import itertools
+import lzma
 import math
+import mmap
 import os.path
+import shutil
+import subprocess
+import sys
 import tarfile
 import tempfile
 import threading
+import time
 import traceback
+import zlib
 
 import boto3
 import click
+from botocore.config import Config
 from tqdm import tqdm
 
-from .utils.tree_hash import calculate_total_tree_hash, calculate_tree_hash
+from .utils import checkpoint
+from .utils.transfer import (
+    MAX_AUTO_THREADS,
+    MIN_AUTO_THREADS,
+    retry_delay,
+    tune_num_threads,
+)
+from .utils.tree_hash import (
+    calculate_part_hashes,
+    calculate_total_tree_hash,
+    calculate_tree_hash,
+)
 
 SINGLE_UPLOAD_THRESHOLD_BYTES = 100 * 1024 * 1024  # 100 MB
 MAX_UPLOAD_ATTEMPTS = 10  # 10 retries for each part before failing
@@ -35,37 +59,119 @@ MAX_UPLOAD_ATTEMPTS = 10  # 10 retries for each part before failing
 MAX_NUMBER_OF_PARTS = 10000
 MIN_PART_SIZE_MB = 1
 MAX_PART_SIZE_MB = 4 * 1024
+DEFAULT_PART_SIZE_MB = 8
+
+# a directory is consolidated while it's uploaded, instead of into a temporary
+# file first, when the parts held in memory by the upload threads fit in this
+STREAM_MAX_BUFFER_BYTES = 1024 * 1024 * 1024
+
+# compressors that use every core, used instead of the python modules if installed
+PARALLEL_COMPRESSORS = {
+    "xz": ["xz", "-T0"],
+    "gz": ["pigz", "--no-name"],
+    "bz2": ["pbzip2"],
+    "zstd": ["zstd", "-T0", "-q"],
+}
 
 
 def upload_archive(
-    vault_name, file_name, arc_desc, part_size_mb, num_threads, upload_id
+    vault_name,
+    file_name,
+    arc_desc,
+    part_size_mb,
+    num_threads,
+    upload_id,
+    compression,
+    compression_level,
 ):
-    glacier = boto3.client("glacier")
+    glacier = boto3.client(
+        "glacier",
+        config=Config(
+            # one pooled connection per worker thread, botocore defaults to 10
+            max_pool_connections=max(num_threads or MAX_AUTO_THREADS, 10),
+            # botocore retries failed requests, upload_part only retries parts
+            # whose checksum doesn't match
+            retries={"mode": "standard", "total_max_attempts": MAX_UPLOAD_ATTEMPTS},
+            tcp_keepalive=True,
+        ),
+    )
+    glacier.meta.events.register_first(
+        "before-call.glacier.UploadMultipartPart", add_content_sha256
+    )
 
-    if part_size_mb < MIN_PART_SIZE_MB or part_size_mb > MAX_PART_SIZE_MB:
+    if part_size_mb is not None:
+        if part_size_mb < MIN_PART_SIZE_MB or part_size_mb > MAX_PART_SIZE_MB:
+            raise click.ClickException(
+                "part-size must be between "
+                f"{MIN_PART_SIZE_MB} and {MAX_PART_SIZE_MB} MB"
+            )
+        if not math.log2(part_size_mb).is_integer():
+            raise click.ClickException("part-size must be a power of 2")
+    if compression_level == 0 and compression in ("gz", "bz2", "zstd"):
         raise click.ClickException(
-            f"part-size must be between {MIN_PART_SIZE_MB} and {MAX_PART_SIZE_MB} MB"
+            f"compression-level for {compression} must be between 1 and 9"
         )
-    if not math.log2(part_size_mb).is_integer():
-        raise click.ClickException("part-size must be a power of 2")
+    if compression == "zstd" and shutil.which("zstd") is None:
+        raise click.ClickException("zstd compression needs the zstd command installed")
+
+    if upload_id is not None:
+        part_size_mb = resumed_part_size(glacier, vault_name, upload_id, part_size_mb)
+
+    consolidated = len(file_name) > 1 or os.path.isdir(file_name[0])
+    # the compression settings and the tools that apply them change the archive's
+    # bytes, so they're part of what a checkpoint is valid for
+    tar_settings = (
+        [compression, compression_level, archiver_versions(compression)]
+        if consolidated
+        else None
+    )
+
+    if consolidated and upload_id is None:
+        estimated_size_bytes = estimate_tar_size(file_name)
+        stream_part_size_mb = fit_part_size(
+            estimated_size_bytes, part_size_mb or DEFAULT_PART_SIZE_MB
+        )
+        if (
+            estimated_size_bytes >= SINGLE_UPLOAD_THRESHOLD_BYTES
+            and stream_part_size_mb * 1024 * 1024 * (num_threads or MAX_AUTO_THREADS)
+            <= STREAM_MAX_BUFFER_BYTES
+        ):
+            part_size_mb = adjust_part_size(estimated_size_bytes, part_size_mb)
+            click.echo("Consolidating files into a .tar archive while uploading...")
+            streamed_multipart_upload(
+                glacier,
+                vault_name,
+                arc_desc,
+                TarStream(
+                    file_name,
+                    compression,
+                    compression_level,
+                    part_size_mb * 1024 * 1024,
+                ),
+                part_size_mb * 1024 * 1024,
+                num_threads,
+                checkpoint.source_fingerprint(
+                    file_name, part_size_mb * 1024 * 1024, tar_settings
+                ),
+            )
+            click.echo("Done.")
+            return
 
     file_to_upload = None
     try:
-        if len(file_name) > 1 or os.path.isdir(file_name[0]):
+        if consolidated:
             click.echo("Consolidating files into a .tar archive...")
             file_to_upload = tempfile.TemporaryFile()
-            with tarfile.open(fileobj=file_to_upload, mode="w:xz") as tar:
-                for filename in file_name:
-                    tar.add(filename)
+            consolidate_files(file_name, file_to_upload, compression, compression_level)
             click.echo("Files consolidated.")
         else:
             file_to_upload = open(file_name[0], mode="rb")
-            click.echo("Opened single file.")
+            click.echo("Opened single file, uploading it as is without a .tar archive.")
 
         file_size_bytes = file_to_upload.seek(0, 2)
         file_to_upload.seek(0, 0)  # return file pointer to start of file
 
-        if file_size_bytes < SINGLE_UPLOAD_THRESHOLD_BYTES:
+        if upload_id is None and file_size_bytes < SINGLE_UPLOAD_THRESHOLD_BYTES:
             click.echo(
                 f"File size is less than {SINGLE_UPLOAD_THRESHOLD_BYTES:,} bytes. "
                 "Uploading in one request..."
@@ -79,37 +185,31 @@ def upload_archive(
             click.echo(f"Location: {response['location']}")
             click.echo(f"Archive ID: {response['archiveId']}")
         else:
-            if (
-                math.ceil(file_size_bytes / (part_size_mb * 1024 * 1024))
-                > MAX_NUMBER_OF_PARTS
-            ):
-                target_part_size = file_size_bytes / (10000 * 1024 * 1024)
-                new_part_size = MIN_PART_SIZE_MB
-                while new_part_size < target_part_size:
-                    # find the nearest power of 2 larger than the target part size
-                    new_part_size *= 2
-                    if new_part_size > MAX_PART_SIZE_MB:
-                        raise click.ClickException(
-                            "Archive/upload size too large (more than 40 TB)"
-                        )
-                click.confirm(
-                    "Maximum number of parts exceeded, would you like to "
-                    f"switch to {new_part_size} MB part size?",
-                    default=True,
-                    abort=True,
-                )
-                part_size_mb = new_part_size
+            if upload_id is None:
+                part_size_mb = adjust_part_size(file_size_bytes, part_size_mb)
 
-            multipart_upload(
-                glacier,
-                upload_id,
-                vault_name,
-                arc_desc,
-                file_size_bytes,
-                part_size_mb * 1024 * 1024,
-                file_to_upload,
-                num_threads,
-            )
+            # map the file so parts can be hashed and sent straight from the page
+            # cache, without each worker copying its part into a bytes object
+            with mmap.mmap(
+                file_to_upload.fileno(), 0, access=mmap.ACCESS_READ
+            ) as file_map:
+                # parts are read in order, so let the kernel read further ahead
+                # and drop pages behind the reader sooner
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    file_map.madvise(mmap.MADV_SEQUENTIAL)
+                multipart_upload(
+                    glacier,
+                    upload_id,
+                    vault_name,
+                    arc_desc,
+                    file_size_bytes,
+                    part_size_mb * 1024 * 1024,
+                    file_map,
+                    num_threads,
+                    checkpoint.source_fingerprint(
+                        file_name, part_size_mb * 1024 * 1024, tar_settings
+                    ),
+                )
     finally:
         if file_to_upload is not None:
             file_to_upload.close()
@@ -117,6 +217,153 @@ def upload_archive(
     click.echo("Done.")
 
 
+def fit_part_size(file_size_bytes, part_size_mb):
+    if math.ceil(file_size_bytes / (part_size_mb * 1024 * 1024)) <= MAX_NUMBER_OF_PARTS:
+        return part_size_mb
+
+    target_part_size = file_size_bytes / (10000 * 1024 * 1024)
+    new_part_size = MIN_PART_SIZE_MB
+    while new_part_size < target_part_size:
+        # find the nearest power of 2 larger than the target part size
+        new_part_size *= 2
+        if new_part_size > MAX_PART_SIZE_MB:
+            raise click.ClickException(
+                "Archive/upload size too large (more than 40 TB)"
+            )
+    return new_part_size
+
+
+def adjust_part_size(file_size_bytes, part_size_mb):
+    if part_size_mb is None:
+        # no part size was asked for, so go up from the default without asking
+        return fit_part_size(file_size_bytes, DEFAULT_PART_SIZE_MB)
+
+    new_part_size = fit_part_size(file_size_bytes, part_size_mb)
+    if new_part_size != part_size_mb:
+        click.confirm(
+            "Maximum number of parts exceeded, would you like to "
+            f"switch to {new_part_size} MB part size?",
+            default=True,
+            abort=True,
+        )
+    return new_part_size
+
+
+def resumed_part_size(glacier, vault_name, upload_id, part_size_mb):
+    # a resumed upload keeps the part size it was started with, which may have been
+    # fitted to a different size, like a streamed archive's estimate
+    try:
+        response = glacier.list_parts(
+            vaultName=vault_name, uploadId=upload_id, limit="1"
+        )
+    except glacier.exceptions.ResourceNotFoundException as e:
+        raise click.ClickException(e.response["Error"]["Message"])
+
+    upload_part_size_mb = response["PartSizeInBytes"] // (1024 * 1024)
+    if part_size_mb is not None and part_size_mb != upload_part_size_mb:
+        raise click.ClickException(
+            f"Upload {upload_id} was started with {upload_part_size_mb} MB parts, "
+            "part-size must match it to resume"
+        )
+    return upload_part_size_mb
+
+
+def estimate_tar_size(file_names):
+    # an upper bound on the size of the archive: a 512 byte header per member,
+    # data padded to 512 byte blocks, the end of archive marker, and a margin for
+    # xz output that ends up larger than its input
+    size_bytes = 1024
+    for file_name in file_names:
+        for path in walk_tar_members(file_name):
+            size_bytes += 512
+            if os.path.isfile(path) and not os.path.islink(path):
+                size_bytes += -(-os.path.getsize(path) // 512) * 512
+    return size_bytes + size_bytes // 100
+
+
+def walk_tar_members(file_name):
+    yield file_name
+    if os.path.isdir(file_name) and not os.path.islink(file_name):
+        for root, dirs, files in os.walk(file_name):
+            for name in dirs + files:
+                yield os.path.join(root, name)
+
+
+def parallel_compressor(compression):
+    # the command line of the installed parallel compressor, or None
+    command = PARALLEL_COMPRESSORS.get(compression)
+    command_path = command and shutil.which(command[0])
+    if command_path is None:
+        return None
+    return [command_path, *command[1:]]
+
+
+def archiver_versions(compression):
+    # tarfile and the python compression modules come with python itself, while a
+    # parallel compressor is identified by its path and its version output
+    versions = [sys.version]
+    command = parallel_compressor(compression)
+    if command is not None:
+        result = subprocess.run(
+            [command[0], "--version"], capture_output=True, text=True
+        )
+        versions += [command[0], result.stdout + result.stderr]
+    elif compression == "gz":
+        versions.append(zlib.ZLIB_RUNTIME_VERSION)
+    return versions
+
+
+def consolidate_files(file_names, file_to_upload, compression, compression_level):
+    command = parallel_compressor(compression)
+    if command is None:
+        with open_compressor(
+            file_to_upload, compression, compression_level
+        ) as compressed, tarfile.open(fileobj=compressed, mode="w|") as tar:
+            for filename in file_names:
+                tar.add(filename)
+        return
+
+    # the python compression modules only use one core, so when a parallel
+    # compressor is installed stream the tar through it instead
+    args = [*command, "-c"]
+    if compression_level is not None:
+        args.append(f"-{compression_level}")
+    with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=file_to_upload) as proc:
+        with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+            for filename in file_names:
+                tar.add(filename)
+    if proc.returncode != 0:
+        raise click.ClickException(
+            f"{os.path.basename(command[0])} exited with status {proc.returncode}"
+        )
+
+
+def open_compressor(file_to_upload, compression, compression_level):
+    if compression == "xz":
+        return lzma.LZMAFile(
+            file_to_upload,
+            mode="wb",
+            preset=6 if compression_level is None else compression_level,
+        )
+    if compression == "gz":
+        # no file name or timestamp in the header, so the same files always
+        # produce the same archive and an upload can be resumed
+        return gzip.GzipFile(
+            filename="",
+            mode="wb",
+            compresslevel=9 if compression_level is None else compression_level,
+            fileobj=file_to_upload,
+            mtime=0,
+        )
+    if compression == "bz2":
+        return bz2.BZ2File(
+            file_to_upload,
+            mode="wb",
+            compresslevel=9 if compression_level is None else compression_level,
+        )
+    return contextlib.nullcontext(file_to_upload)
+
+
 def multipart_upload(
     glacier,
     upload_id,
@@ -126,6 +373,7 @@ def multipart_upload(
     part_size_bytes,
     file_to_upload,
     num_threads,
+    source_id,
 ):
     part_list = {}  # map of byte_start -> checksum
     for byte_start in range(0, file_size_bytes, part_size_bytes):
@@ -140,6 +388,8 @@ def multipart_upload(
             partSize=str(part_size_bytes),
         )
         upload_id = response["uploadId"]
+        checkpoint_file = checkpoint.upload_checkpoint_path(upload_id)
+        checkpoint.start_checkpoint(checkpoint_file, source_id, {})
 
         click.echo(
             f"File size is {file_size_bytes:,} bytes. "
@@ -147,73 +397,234 @@ def multipart_upload(
         )
     else:
         click.echo(f"Resuming upload with id {upload_id}...")
+        checkpoint_file = checkpoint.upload_checkpoint_path(upload_id)
+
+        # parts recorded by an earlier run from the same source need no re-hashing
+        known_checksums = checkpoint.load_checkpoint(checkpoint_file, source_id)
 
         click.echo("Fetching already uploaded parts...")
+        paginator = glacier.get_paginator("list_parts")
+        response = paginator.paginate(vaultName=vault_name, uploadId=upload_id)
         try:
-            paginator = glacier.get_paginator("list_parts")
-            response = paginator.paginate(vaultName=vault_name, uploadId=upload_id)
-            parts = list(response.search("Parts"))
+            verified_parts = verify_parts(
+                file_to_upload,
+                part_size_bytes,
+                known_checksums,
+                response.search("Parts"),
+                num_threads or MAX_AUTO_THREADS,
+            )
+            for byte_start, checksum in tqdm(
+                verified_parts, desc="Verifying uploaded parts"
+            ):
+                if checksum is not None:
+                    part_list[byte_start] = checksum
         except glacier.exceptions.ResourceNotFoundException as e:
             raise click.ClickException(e.response["Error"]["Message"])
 
-        for part_data in tqdm(parts, desc="Verifying uploaded parts"):
-            byte_start = int(part_data["RangeInBytes"].partition("-")[0])
-            file_to_upload.seek(byte_start)
-            part = file_to_upload.read(part_size_bytes)
-            checksum = calculate_tree_hash(part, part_size_bytes)
+        checkpoint.start_checkpoint(
+            checkpoint_file,
+            source_id,
+            {
+                byte_start: checksum
+                for byte_start, checksum in part_list.items()
+                if checksum is not None
+            },
+        )
+
+    parts_to_upload = [
+        byte_start for byte_start, checksum in part_list.items() if checksum is None
+    ]
+    upload_parts(
+        glacier,
+        vault_name,
+        upload_id,
+        mapped_parts(file_to_upload, parts_to_upload, part_size_bytes),
+        part_list,
+        part_size_bytes,
+        file_size_bytes,
+        num_parts,
+        num_threads,
+    )
+    complete_multipart_upload(
+        glacier, vault_name, upload_id, file_size_bytes, part_list
+    )
+
+
+def streamed_multipart_upload(
+    glacier, vault_name, arc_desc, tar_stream, part_size_bytes, num_threads, source_id
+):
+    click.echo("Initiating multipart upload...")
+    response = glacier.initiate_multipart_upload(
+        vaultName=vault_name,
+        archiveDescription=arc_desc,
+        partSize=str(part_size_bytes),
+    )
+    upload_id = response["uploadId"]
+    checkpoint_file = checkpoint.upload_checkpoint_path(upload_id)
+    checkpoint.start_checkpoint(checkpoint_file, source_id, {})
+    click.echo(f"Will upload in parts of {part_size_bytes:,} bytes.")
+
+    part_list = {}  # map of byte_start -> checksum
+    upload_parts(
+        glacier,
+        vault_name,
+        upload_id,
+        tar_stream.parts(),
+        part_list,
+        part_size_bytes,
+        None,
+        None,
+        num_threads,
+    )
+    click.echo(f"Files consolidated. Archive size is {tar_stream.size_bytes:,} bytes.")
+    complete_multipart_upload(
+        glacier, vault_name, upload_id, tar_stream.size_bytes, part_list
+    )
+
 
-            if checksum == part_data["SHA256TreeHash"]:
-                part_list[byte_start] = checksum
+def upload_parts(
+    glacier,
+    vault_name,
+    upload_id,
+    parts,
+    part_list,
+    part_size_bytes,
+    file_size_bytes,
+    num_parts,
+    num_threads,
+):
+    # parts yields (byte_start, memoryview) pairs, file_size_bytes and num_parts
+    # are None when the archive is still being consolidated while it's uploaded
+    try:
+        _upload_parts(
+            glacier,
+            vault_name,
+            upload_id,
+            parts,
+            part_list,
+            part_size_bytes,
+            file_size_bytes,
+            num_parts,
+            num_threads,
+        )
+    finally:
+        parts.close()
+
+
+def _upload_parts(
+    glacier,
+    vault_name,
+    upload_id,
+    parts,
+    part_list,
+    part_size_bytes,
+    file_size_bytes,
+    num_parts,
+    num_threads,
+):
+    checkpoint_file = checkpoint.upload_checkpoint_path(upload_id)
+    if num_threads is None:
+        num_threads = MIN_AUTO_THREADS
+        try:
+            byte_pos, part = next(parts, (None, None))
+        except Exception as exc:
+            abort_multipart_upload(upload_id, [exc])
+        if part is not None:
+            # upload the first part on its own to measure what one connection does
+            click.echo("Measuring upload speed with the first part...")
+            probe_size_bytes = len(part)
+            try:
+                part_list[byte_pos], transfer_seconds = upload_part(
+                    byte_pos,
+                    part,
+                    vault_name,
+                    upload_id,
+                    part_size_bytes,
+                    file_size_bytes,
+                    num_parts,
+                    glacier,
+                )
+            except Exception as exc:
+                abort_multipart_upload(upload_id, [exc])
+            checkpoint.record_part(checkpoint_file, byte_pos, part_list[byte_pos])
+            num_threads = tune_num_threads(probe_size_bytes, transfer_seconds)
+            click.echo(f"Will upload with {num_threads} threads.")
 
     click.echo("Spawning threads...")
     with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        fileblock = threading.Lock()
-        futures_list = {}
-        for byte_pos in [
-            part for part, checksum in part_list.items() if checksum is None
-        ]:
-            future = executor.submit(
-                upload_part,
-                byte_pos,
-                vault_name,
-                upload_id,
-                part_size_bytes,
-                file_to_upload,
-                file_size_bytes,
-                num_parts,
-                glacier,
-                fileblock,
+        futures_list = {}  # map of in-flight future -> byte_start
+        errors = []
+        parts_left = True
+        while not errors:
+            # top up the in-flight window so exactly num_threads parts are uploading
+            while len(futures_list) < num_threads and parts_left:
+                try:
+                    byte_pos, part = next(parts)
+                except StopIteration:
+                    parts_left = False
+                    break
+                except Exception as exc:
+                    errors.append(exc)
+                    break
+                future = executor.submit(
+                    upload_part,
+                    byte_pos,
+                    part,
+                    vault_name,
+                    upload_id,
+                    part_size_bytes,
+                    file_size_bytes,
+                    num_parts,
+                    glacier,
+                )
+                futures_list[future] = byte_pos
+            if not futures_list:
+                # all parts uploaded
+                break
+
+            done, _ = concurrent.futures.wait(
+                futures_list, return_when=concurrent.futures.FIRST_COMPLETED
             )
-            futures_list[future] = byte_pos
-        done, not_done = concurrent.futures.wait(
-            futures_list, return_when=concurrent.futures.FIRST_EXCEPTION
-        )
-        if len(not_done) > 0:
-            # an exception occurred
-            for future in not_done:
-                future.cancel()
             for future in done:
+                byte_start = futures_list.pop(future)
                 exc = future.exception()
-                if exc is not None:
-                    exc_string = "".join(traceback.format_exception(exc))
-                    click.secho(f"Exception occurred: {exc_string}", err=True, fg="red")
-            click.echo(f"Upload can still be resumed. Upload ID: {upload_id}")
-            raise click.Abort
-        else:
-            # all threads completed without raising an Exception
-            for future in done:
-                byte_start = futures_list[future]
-                part_list[byte_start] = future.result()
+                if exc is None:
+                    part_list[byte_start], _ = future.result()
+                    checkpoint.record_part(
+                        checkpoint_file, byte_start, part_list[byte_start]
+                    )
+                else:
+                    errors.append(exc)
+
+        if errors:
+            # stop scheduling new parts, the ones still in flight are left to finish
+            # and checkpointed so that resuming doesn't need to hash them again
+            for future in concurrent.futures.as_completed(futures_list):
+                exc = future.exception()
+                if exc is None:
+                    checkpoint.record_part(
+                        checkpoint_file, futures_list[future], future.result()[0]
+                    )
+                else:
+                    errors.append(exc)
+            abort_multipart_upload(upload_id, errors)
 
-    total_tree_hash = calculate_total_tree_hash(list(part_list.values()))
+
+def complete_multipart_upload(
+    glacier, vault_name, upload_id, archive_size_bytes, part_list
+):
+    total_tree_hash = calculate_total_tree_hash(
+        [part_list[byte_start] for byte_start in sorted(part_list)]
+    )
 
     click.echo("Completing multipart upload...")
     response = glacier.complete_multipart_upload(
         vaultName=vault_name,
         uploadId=upload_id,
-        archiveSize=str(file_size_bytes),
+        archiveSize=str(archive_size_bytes),
         checksum=total_tree_hash,
     )
+    checkpoint.remove_checkpoint(checkpoint.upload_checkpoint_path(upload_id))
     click.echo("Upload successful.")
     click.echo(f"Calculated total tree hash: {total_tree_hash}")
     click.echo(f"Glacier total tree hash: {response['checksum']}")
@@ -221,55 +632,237 @@ def multipart_upload(
     click.echo(f"Archive ID: {response['archiveId']}")
 
 
+def abort_multipart_upload(upload_id, errors):
+    for exc in errors:
+        exc_string = "".join(traceback.format_exception(exc))
+        click.secho(f"Exception occurred: {exc_string}", err=True, fg="red")
+    click.echo(f"Upload can still be resumed. Upload ID: {upload_id}")
+    raise click.Abort
+
+
 def upload_part(
     start_pos,
+    part,
     vault_name,
     upload_id,
     part_size_bytes,
-    fp,
     file_size_bytes,
     num_parts,
     glacier,
-    fileblock,
 ):
-    with fileblock:
-        fp.seek(start_pos)
-        part = fp.read(part_size_bytes)
+    # returns the part's checksum and how long the successful attempt took
+    with part:
+        end_pos = start_pos + len(part) - 1
+        # the total size is left out while the archive is still being consolidated
+        range_header = f"bytes {start_pos}-{end_pos}/{file_size_bytes or '*'}"
+        part_num = start_pos // part_size_bytes
+        checksum, content_sha256 = calculate_part_hashes(part, part_size_bytes)
+
+        if num_parts is None:
+            click.echo(f"Uploading part {part_num + 1}...")
+        else:
+            percentage = part_num / num_parts
+            click.echo(
+                f"Uploading part {part_num + 1} of {num_parts}... ({percentage:.2%})"
+            )
+
+        for attempt in range(MAX_UPLOAD_ATTEMPTS):
+            if attempt > 0:
+                click.echo(f"Trying again. Part {part_num + 1}")
+                time.sleep(retry_delay(attempt))
+            started = time.monotonic()
+            # passing our own tree hash stops botocore from hashing the part again
+            # on every attempt
+            response = glacier.upload_multipart_part(
+                vaultName=vault_name,
+                uploadId=upload_id,
+                range=range_header,
+                body=PartReader(part, content_sha256),
+                checksum=checksum,
+            )
+            if checksum == response["checksum"]:
+                # upload success, exit loop
+                transfer_seconds = time.monotonic() - started
+                break
+            click.secho(
+                "Upload error: Local checksum does not match Glacier checksum",
+                err=True,
+                fg="red",
+            )
+        else:
+            click.secho(
+                f"After {MAX_UPLOAD_ATTEMPTS} attempts, "
+                f"still failed to upload part. Aborting upload of part {part_num + 1}.",
+                err=True,
+                fg="red",
+            )
+            raise RuntimeError("Local checksum does not match Glacier checksum")
+
+        return checksum, transfer_seconds
 
-    end_pos = start_pos + len(part) - 1
-    range_header = f"bytes {start_pos}-{end_pos}/{file_size_bytes}"
-    part_num = start_pos // part_size_bytes
-    percentage = part_num / num_parts
-    checksum = calculate_tree_hash(part, part_size_bytes)
 
-    click.echo(f"Uploading part {part_num + 1} of {num_parts}... ({percentage:.2%})")
+def add_content_sha256(params, **kwargs):
+    # botocore hashes the whole body for the x-amz-content-sha256 header on every
+    # attempt unless the header is already set, so reuse the hash computed
+    # alongside the part's tree hash instead
+    body = params["body"]
+    if isinstance(body, PartReader) and body.sha256 is not None:
+        params["headers"]["x-amz-content-sha256"] = body.sha256
 
-    error = None
-    for _ in range(MAX_UPLOAD_ATTEMPTS):
+
+def verify_parts(file_map, part_size_bytes, known_checksums, listed_parts, num_threads):
+    # yields (byte_start, checksum) for every listed part, with checksum None if
+    # the part doesn't match the file. Only num_threads parts are taken from the
+    # listing at a time, so its pages are fetched as verification gets to them.
+    listed_parts = iter(listed_parts)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        in_flight = set()
         try:
-            response = glacier.upload_multipart_part(
-                vaultName=vault_name, uploadId=upload_id, range=range_header, body=part
+            while True:
+                for part_data in itertools.islice(
+                    listed_parts, num_threads - len(in_flight)
+                ):
+                    in_flight.add(
+                        executor.submit(
+                            verify_part,
+                            file_map,
+                            part_size_bytes,
+                            known_checksums,
+                            part_data,
+                        )
+                    )
+                if not in_flight:
+                    return
+                done, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+def verify_part(file_map, part_size_bytes, known_checksums, part_data):
+    byte_start = int(part_data["RangeInBytes"].partition("-")[0])
+    if known_checksums.get(byte_start) == part_data["SHA256TreeHash"]:
+        return byte_start, part_data["SHA256TreeHash"]
+
+    with read_part(file_map, byte_start, part_size_bytes) as part:
+        checksum = calculate_tree_hash(part, part_size_bytes)
+
+    if checksum != part_data["SHA256TreeHash"]:
+        return byte_start, None
+    return byte_start, checksum
+
+
+def read_part(file_map, start_pos, part_size_bytes):
+    return memoryview(file_map)[start_pos : start_pos + part_size_bytes]
+
+
+def mapped_parts(file_map, part_starts, part_size_bytes):
+    for i, byte_start in enumerate(part_starts):
+        if i + 1 < len(part_starts):
+            # have the next part read from disk while this one uploads
+            prefetch_part(file_map, part_starts[i + 1], part_size_bytes)
+        yield byte_start, read_part(file_map, byte_start, part_size_bytes)
+
+
+def prefetch_part(file_map, start_pos, part_size_bytes):
+    # MADV_WILLNEED starts an asynchronous read-ahead of the range into the page
+    # cache, so the worker that picks this part up doesn't stall on disk reads
+    if hasattr(mmap, "MADV_WILLNEED"):
+        file_map.madvise(mmap.MADV_WILLNEED, start_pos, part_size_bytes)
+
+
+class TarStream:
+    """
+    Consolidate files into a .tar archive on a background thread and hand the
+    archive out one part at a time, so that it never has to be written to disk.
+    """
+
+    def __init__(self, file_names, compression, compression_level, part_size_bytes):
+        self.file_names = file_names
+        self.compression = compression
+        self.compression_level = compression_level
+        self.part_size_bytes = part_size_bytes
+        self.size_bytes = 0
+
+    def parts(self):
+        read_fd, write_fd = os.pipe()
+        errors = []
+        with open(read_fd, "rb") as reader:
+            producer = threading.Thread(
+                target=self._consolidate,
+                args=(open(write_fd, "wb"), errors),
+                daemon=True,
             )
-            if checksum != response["checksum"]:
-                raise Exception("Local checksum does not match Glacier checksum")
+            producer.start()
+            try:
+                while True:
+                    part = reader.read(self.part_size_bytes)
+                    if len(part) < self.part_size_bytes:
+                        # a short read is the end of the archive, make sure it wasn't
+                        # cut short by an error before uploading it
+                        producer.join()
+                        if errors:
+                            raise errors[0]
+                    if not part:
+                        break
+                    byte_start = self.size_bytes
+                    self.size_bytes += len(part)
+                    yield byte_start, memoryview(part)
+            finally:
+                # closing the pipe early makes the producer's next write fail
+                reader.close()
+                producer.join()
 
-            # upload success, exit loop
-            break
+    def _consolidate(self, writer, errors):
+        try:
+            with writer:
+                consolidate_files(
+                    self.file_names, writer, self.compression, self.compression_level
+                )
         except Exception as e:
-            click.secho(f"Upload error: {e}", err=True, fg="red")
-            click.echo(f"Trying again. Part {part_num + 1}")
-            error = e
-    else:
-        click.secho(
-            f"After {MAX_UPLOAD_ATTEMPTS} attempts, "
-            f"still failed to upload part. Aborting upload of part {part_num + 1}.",
-            err=True,
-            fg="red",
-        )
-        if error is not None:
-            raise error
-        else:
-            raise RuntimeError()
+            errors.append(e)
+
+
+class PartReader(io.RawIOBase):
+    """
+    Read-only file object over a memoryview, so that a part can be used as a
+    request body without first being copied into a bytes object.
+    """
+
+    def __init__(self, view, sha256=None):
+        self._view = view
+        self._pos = 0
+        # linear SHA-256 of the whole view, if already known
+        self.sha256 = sha256
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(offset, 0)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._pos + size
+        data = self._view[self._pos : end].tobytes()
+        self._pos += len(data)
+        return data
 
-    del part  # freeing memory
-    return checksum
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
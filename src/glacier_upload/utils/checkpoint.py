@@ -0,0 +1,118 @@
+# A tool to upload and manage archives in AWS Glacier Vaults.
+# Copyright (C) 2023 Trapsilo P. Bumi tbumi@thpd.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Checkpoints record the tree hash of every part transferred in a multipart
+# upload or download, so that resuming it knows which parts are already done
+# without hashing or requesting all of them again. Each checkpoint is a JSON
+# lines file: a header identifying the source, followed by one
+# {"byte_start": ..., "checksum": ...} line per part.
+
+import hashlib
+import json
+import os
+
+import click
+
+
+def checkpoint_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "glacier-upload", "uploads")
+
+
+def upload_checkpoint_path(upload_id):
+    return os.path.join(checkpoint_dir(), f"{upload_id}.jsonl")
+
+
+def source_fingerprint(file_names, part_size_bytes, settings=None):
+    # the metadata of every entry that goes into the uploaded archive, so that a
+    # checkpoint is only trusted while the files being uploaded are unchanged,
+    # along with any settings that change how they're turned into the archive.
+    # A tar records directories, permissions and owners too, so those count.
+    entries = []
+    for file_name in file_names:
+        entries.append(_stat_entry(file_name))
+        if os.path.isdir(file_name) and not os.path.islink(file_name):
+            for root, dirs, files in os.walk(file_name):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    entries.append(_stat_entry(os.path.join(root, name)))
+    source = json.dumps([part_size_bytes, settings, entries])
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def _stat_entry(path):
+    stat = os.lstat(path)
+    return [
+        os.path.abspath(path),
+        stat.st_mode,
+        stat.st_uid,
+        stat.st_gid,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    ]
+
+
+def load_checkpoint(path, source_id):
+    try:
+        with open(path) as f:
+            header = json.loads(f.readline())
+            if header.get("source") != source_id:
+                return {}
+            checksums = {}
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # the last record may have been cut short by a crash
+                checksums[record["byte_start"]] = record["checksum"]
+            return checksums
+    except (OSError, ValueError):
+        return {}
+
+
+def start_checkpoint(path, source_id, checksums):
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(json.dumps({"source": source_id}) + "\n")
+            for byte_start, checksum in checksums.items():
+                f.write(_record(byte_start, checksum))
+    except OSError as e:
+        click.secho(f"Unable to write checkpoint: {e}", err=True, fg="yellow")
+
+
+def record_part(path, byte_start, checksum):
+    try:
+        with open(path, "a") as f:
+            f.write(_record(byte_start, checksum))
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError:
+        pass  # a missing checkpoint only means a resume checks this part again
+
+
+def remove_checkpoint(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _record(byte_start, checksum):
+    return json.dumps({"byte_start": byte_start, "checksum": checksum}) + "\n"
@@ -0,0 +1,53 @@
+# A tool to upload and manage archives in AWS Glacier Vaults.
+# Copyright (C) 2023 Trapsilo P. Bumi tbumi@thpd.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+
+import boto3
+import click
+
+# retrieval jobs usually take hours, so polling starts at a minute and backs off
+# to every 15 minutes
+JOB_POLL_BASE_SECONDS = 60
+JOB_POLL_MAX_SECONDS = 15 * 60
+
+
+def initiate_job(vault_name, job_params, description):
+    glacier = boto3.client("glacier")
+
+    if description is not None:
+        job_params = {**job_params, "Description": description}
+
+    click.echo(f"Sending {job_params['Type']} initiation request...")
+    try:
+        response = glacier.initiate_job(vaultName=vault_name, jobParameters=job_params)
+    except glacier.exceptions.ResourceNotFoundException as e:
+        raise click.ClickException(e.response["Error"]["Message"])
+
+    click.echo(f"Job initiation request received. Job ID: {response['jobId']}")
+
+
+def wait_for_job(glacier, vault_name, job_id, job_desc):
+    attempt = 0
+    while not job_desc["Completed"]:
+        delay = min(JOB_POLL_BASE_SECONDS * 2**attempt, JOB_POLL_MAX_SECONDS)
+        click.echo(f"Job is not completed, checking again in {delay // 60} minutes...")
+        time.sleep(delay)
+        attempt += 1
+        job_desc = glacier.describe_job(vaultName=vault_name, jobId=job_id)
+    click.echo(f"Job status: {job_desc['StatusCode']}")
+    return job_desc
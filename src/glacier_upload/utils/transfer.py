@@ -0,0 +1,47 @@
+# A tool to upload and manage archives in AWS Glacier Vaults.
+# Copyright (C) 2023 Trapsilo P. Bumi tbumi@thpd.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Retries and thread counts shared by uploads and downloads, kept apart from the
+# command modules so that each command only imports what it uses.
+
+import math
+import random
+
+MAX_DOWNLOAD_ATTEMPTS = 10  # 10 retries for each part before failing
+RETRY_BASE_DELAY_SECONDS = 0.25
+RETRY_MAX_DELAY_SECONDS = 30
+
+# bounds and target bandwidth (1 Gbit/s) when the number of threads is tuned from
+# the speed of the first part
+MIN_AUTO_THREADS = 4
+MAX_AUTO_THREADS = 32
+AUTO_THREADS_TARGET_BYTES_PER_SEC = 125 * 1000 * 1000
+
+
+def retry_delay(attempt):
+    # exponential backoff with jitter, so throttled threads don't retry in lockstep
+    delay = RETRY_BASE_DELAY_SECONDS * 2**attempt
+    return min(
+        delay + random.uniform(0, RETRY_BASE_DELAY_SECONDS), RETRY_MAX_DELAY_SECONDS
+    )
+
+
+def tune_num_threads(part_size_bytes, transfer_seconds):
+    # a single connection to glacier is usually limited by latency rather than
+    # bandwidth, so open as many as it takes to fill the target bandwidth
+    bytes_per_second = part_size_bytes / max(transfer_seconds, 0.001)
+    num_threads = math.ceil(AUTO_THREADS_TARGET_BYTES_PER_SEC / bytes_per_second)
+    return min(max(num_threads, MIN_AUTO_THREADS), MAX_AUTO_THREADS)
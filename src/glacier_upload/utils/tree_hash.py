@@ -14,30 +14,114 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import hashlib
+import os
+
+LEAF_SIZE = 1024 * 1024  # 1 MB
+
+# hashlib releases the GIL while hashing large buffers, so a thread pool is enough
+# to spread the leaves of a part over every core. Threads are only spawned on
+# first use.
+_leaf_hash_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="tree-hash"
+)
 
 
 def calculate_tree_hash(part, part_size):
-    checksums = []
-    upper_bound = min(len(part), part_size)
-    step = 1024 * 1024  # 1 MB
-    for chunk_pos in range(0, upper_bound, step):
-        chunk = part[chunk_pos : chunk_pos + step]
-        checksums.append(hashlib.sha256(chunk).hexdigest())
-        del chunk
-    return calculate_total_tree_hash(checksums)
+    # slicing a memoryview hands hashlib the underlying buffer without copying
+    with memoryview(part) as view:
+        chunks = _split_leaves(view, part_size)
+        if len(chunks) > 1:
+            digests = list(_leaf_hash_pool.map(_sha256_digest, chunks))
+        else:
+            digests = [_sha256_digest(chunk) for chunk in chunks]
+    return _reduce_tree(digests).hex()
+
+
+def calculate_part_hashes(part, part_size):
+    # the tree hash of a part along with the linear SHA-256 of the whole part that
+    # glacier requests are signed with. The linear hash is computed on the calling
+    # thread while the pool hashes the leaves, so both take a single pass.
+    with memoryview(part) as view:
+        chunks = _split_leaves(view, part_size)
+        leaf_digests = _leaf_hash_pool.map(_sha256_digest, chunks)
+        linear_hash = hashlib.sha256(view[: min(len(view), part_size)]).hexdigest()
+        digests = list(leaf_digests)
+    return _reduce_tree(digests).hex(), linear_hash
 
 
 def calculate_total_tree_hash(list_of_checksums):
-    tree = list_of_checksums[:]
+    return _reduce_tree(
+        [bytes.fromhex(checksum) for checksum in list_of_checksums]
+    ).hex()
+
+
+def _split_leaves(view, part_size):
+    upper_bound = min(len(view), part_size)
+    return [
+        view[chunk_pos : chunk_pos + LEAF_SIZE]
+        for chunk_pos in range(0, upper_bound, LEAF_SIZE)
+    ]
+
+
+def _sha256_digest(chunk):
+    return hashlib.sha256(chunk).digest()
+
+
+def _reduce_tree(digests):
+    # work on raw 32 byte digests, only the root is converted back to hex
+    tree = digests
     while len(tree) > 1:
-        parent = []
-        for i in range(0, len(tree), 2):
-            if i < len(tree) - 1:
-                part1 = bytes.fromhex(tree[i])
-                part2 = bytes.fromhex(tree[i + 1])
-                parent.append(hashlib.sha256(part1 + part2).hexdigest())
-            else:
-                parent.append(tree[i])
+        # hashing the 64 byte nodes is negligible next to hashing the 1 MB leaves
+        parent = [
+            hashlib.sha256(tree[i] + tree[i + 1]).digest()
+            for i in range(0, len(tree) - 1, 2)
+        ]
+        if len(tree) % 2:
+            parent.append(tree[-1])
         tree = parent
     return tree[0]
+
+
+class TreeHasher:
+    """
+    Tree hash of data that arrives in chunks of any size, keeping only the leaf
+    being hashed and one digest per level of the tree.
+    """
+
+    def __init__(self):
+        self._leaf = hashlib.sha256()
+        self._leaf_size = 0
+        self._stack = []  # (level, digest) of completed subtrees, left to right
+
+    def update(self, data):
+        with memoryview(data) as view:
+            pos = 0
+            while pos < len(view):
+                size = min(len(view) - pos, LEAF_SIZE - self._leaf_size)
+                self._leaf.update(view[pos : pos + size])
+                self._leaf_size += size
+                pos += size
+                if self._leaf_size == LEAF_SIZE:
+                    self._push(self._leaf.digest())
+                    self._leaf = hashlib.sha256()
+                    self._leaf_size = 0
+
+    def hexdigest(self):
+        digests = [digest for _, digest in self._stack]
+        if self._leaf_size or not digests:
+            digests.append(self._leaf.digest())
+        # subtrees left on the stack get smaller to the right, which is the same
+        # as carrying the odd node up each level
+        root = digests[-1]
+        for digest in reversed(digests[:-1]):
+            root = hashlib.sha256(digest + root).digest()
+        return root.hex()
+
+    def _push(self, digest):
+        level = 0
+        while self._stack and self._stack[-1][0] == level:
+            digest = hashlib.sha256(self._stack.pop()[1] + digest).digest()
+            level += 1
+        self._stack.append((level, digest))
@@ -0,0 +1,87 @@
+# A tool to upload and manage archives in AWS Glacier Vaults.
+# Copyright (C) 2023 Trapsilo P. Bumi tbumi@thpd.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from glacier_upload.utils import checkpoint
+
+PART_SIZE_BYTES = 8 * 1024 * 1024
+
+
+class SourceFingerprintTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.source = os.path.join(tmp.name, "source")
+        os.makedirs(os.path.join(self.source, "sub"))
+        for name in ("f1", "f2"):
+            with open(os.path.join(self.source, name), "wb") as f:
+                f.write(name.encode())
+
+        env = mock.patch.dict(
+            os.environ, {"XDG_CACHE_HOME": os.path.join(tmp.name, "cache")}
+        )
+        env.start()
+        self.addCleanup(env.stop)
+        self.checkpoint_file = checkpoint.upload_checkpoint_path("upload")
+
+    def fingerprint(self):
+        return checkpoint.source_fingerprint([self.source], PART_SIZE_BYTES)
+
+    def assert_checkpoint_discarded(self, change):
+        source_id = self.fingerprint()
+        checkpoint.start_checkpoint(self.checkpoint_file, source_id, {0: "ab" * 32})
+        self.assertEqual(
+            checkpoint.load_checkpoint(self.checkpoint_file, self.fingerprint()),
+            {0: "ab" * 32},
+        )
+
+        change()
+        self.assertNotEqual(self.fingerprint(), source_id)
+        self.assertEqual(
+            checkpoint.load_checkpoint(self.checkpoint_file, self.fingerprint()), {}
+        )
+
+    def test_unchanged_source_keeps_checkpoint(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_new_empty_directory_discards_checkpoint(self):
+        self.assert_checkpoint_discarded(
+            lambda: os.mkdir(os.path.join(self.source, "empty"))
+        )
+
+    def test_mode_change_discards_checkpoint(self):
+        self.assert_checkpoint_discarded(
+            lambda: os.chmod(os.path.join(self.source, "f1"), 0o600)
+        )
+
+    def test_directory_mode_change_discards_checkpoint(self):
+        self.assert_checkpoint_discarded(
+            lambda: os.chmod(os.path.join(self.source, "sub"), 0o700)
+        )
+
+    def test_settings_are_part_of_fingerprint(self):
+        self.assertNotEqual(
+            checkpoint.source_fingerprint([self.source], PART_SIZE_BYTES, ["xz", 6]),
+            checkpoint.source_fingerprint([self.source], PART_SIZE_BYTES, ["xz", 9]),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()